@@ -19,7 +19,7 @@
 import sys
 import logging
 
-from flask import Flask, jsonify
+from flask import Flask
 
 from icaas.version import __version__
 from icaas.models import db
@@ -61,9 +61,7 @@ def create_app(**kwargs):
     # Override the default error handler
     @app.errorhandler(Error)
     def handle_invalid_usage(error):
-        response = jsonify(error.to_dict())
-        response.status_code = error.status
-        return response
+        return error.to_response()
 
     # register our blueprints
     app.register_blueprint(builds)
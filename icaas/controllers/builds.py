@@ -20,47 +20,106 @@
 from flask import (
     request,
     jsonify,
+    json,
     Response,
     Blueprint,
     copy_current_request_context
 )
 
 from functools import wraps
+from collections import namedtuple
 from datetime import datetime, timedelta
 from base64 import b64encode
-import ConfigParser
-import StringIO
 import logging
 import threading
-import json
+import hashlib
+
+from sqlalchemy.orm import load_only
 
 from kamaki.clients import cyclades, ClientError
 from kamaki.clients.utils import https
 
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import astakosclient
+import cachetools
 
 from icaas.models import Build, User, db
 from icaas.error import Error
-from icaas.utils import destroy_agent
+from icaas.utils import destroy_agent_vm
 from icaas import settings
 
 https.patch_with_certs(settings.KAMAKI_SSL_LOCATION)
 
 builds = Blueprint('builds', __name__)
 
+# The settings don't change at runtime. Bind the ones used on every request
+_ENDPOINT = settings.ENDPOINT
+_AUTH_URL = settings.AUTH_URL
+_COMPUTE_URL = settings.COMPUTE_URL
+_AGENT_IMAGE_ID = settings.AGENT_IMAGE_ID
+_AGENT_IMAGE_FLAVOR_ID = settings.AGENT_IMAGE_FLAVOR_ID
+_MANIFEST_TIMEOUT = timedelta(minutes=settings.MANIFEST_TIMEOUT)
+
 AGENT_CONFIG = "/etc/icaas/manifest.cfg"
 AGENT_INIT = "/.icaas"
+AGENT_INIT_CONTENTS = b64encode(b"empty")
+
+# The agent config file has a fixed shape. This is what ConfigParser.write()
+# would output for it.
+AGENT_CONFIG_TEMPLATE = "[manifest]\nurl = %s/builds/agent/%%d/%%s\n\n" % \
+    _ENDPOINT.replace('%', '%%')
+
+# Parts of the agent manifest that only depend on the settings
+MANIFEST_PROGRESS = {'heuristic': settings.PROGRESS_HEURISTIC,
+                     'interval': settings.PROGRESS_INTERVAL}
+MANIFEST_STATUS_TEMPLATE = "%s/builds/agent/%%s" % \
+    _ENDPOINT.replace('%', '%%')
+MANIFEST_INSECURE = str(settings.INSECURE)
 
 logger = logging.getLogger(__name__)
 
+# Successfully authenticated users, keyed by the hash of their token. The
+# views only need the id of the user, so there is no need to hit the
+# database for the cached ones.
+CachedUser = namedtuple('CachedUser', ('id', 'uuid', 'token_hash'))
+_token_cache = cachetools.TTLCache(maxsize=settings.TOKEN_CACHE_SIZE,
+                                   ttl=settings.TOKEN_CACHE_TTL)
+_token_cache_lock = threading.Lock()
+
+# Minimum time between two updates of the stored token of a user
+_TOKEN_UPDATE_INTERVAL = timedelta(seconds=settings.TOKEN_UPDATE_INTERVAL)
+
+# Workers that look up users in the database while Astakos authenticates them
+_lookups = ThreadPoolExecutor(max_workers=settings.LOOKUP_WORKERS,
+                              thread_name_prefix="LookupThread")
+
+# Workers that create and destroy the ICaaS agent VMs
+_executor = ThreadPoolExecutor(max_workers=settings.AGENT_WORKERS,
+                               thread_name_prefix="AgentThread")
+
+
+def _run_in_background(f):
+    """Run a function in one of the agent workers, logging any failure"""
+    def task():
+        try:
+            f()
+        except Exception:
+            logger.exception('background task "%s" failed' % f.__name__)
+
+    _executor.submit(task)
+
 
 def _build_to_links(build):
-    url = "%s/%s" % (settings.ENDPOINT, build.id)
-    return [{"href": url, "rel": "self"}]
+    return [{"href": "%s/%s" % (_ENDPOINT, build.id), "rel": "self"}]
 
 
 def _update_status_details(build, params):
-    details = build.status_details
+    build.status_details = _merge_status_details(build.status_details, params)
+
+
+def _merge_status_details(details, params):
+    """Returns the JSON encoded status details after applying params"""
     details = json.loads(details) if details else {}
     curtask = params.get('details', None)
     if curtask:
@@ -76,7 +135,7 @@ def _update_status_details(build, params):
                            str(e))
             raise Error("Malformed status details", status=400)
 
-    build.status_details = json.dumps(details)
+    return json.dumps(details)
 
 
 def _build_to_dict(build):
@@ -87,8 +146,8 @@ def _build_to_dict(build):
          "public": build.public,
          "status": build.status,
          "status_details": build.status_details,
-         "image": json.loads(build.image),
-         "log": json.loads(build.log),
+         "image": build.image,
+         "log": build.log,
          "created": build.created,
          "updated": build.updated,
          "links": _build_to_links(build)}
@@ -99,13 +158,12 @@ def _build_to_dict(build):
 def _create_manifest(build, token):
     """Create manifest to be send to the ICaaS Agent VM"""
 
-    image = json.loads(build.image)
-    log = json.loads(build.log)
+    image = build.image
+    log = build.log
 
     manifest = {}
 
-    manifest['progress'] = {'heuristic': settings.PROGRESS_HEURISTIC,
-                            'interval': settings.PROGRESS_INTERVAL}
+    manifest['progress'] = MANIFEST_PROGRESS
 
     manifest['image'] = {'src': build.src,
                          'name': build.name,
@@ -123,11 +181,10 @@ def _create_manifest(build, token):
     if len(build.description):
         manifest['image']['description'] = build.description
 
-    manifest['service'] = {'status': '%s/builds/agent/%s' %
-                                     (settings.ENDPOINT, build.id),
+    manifest['service'] = {'status': MANIFEST_STATUS_TEMPLATE % build.id,
                            'token': build.token,
-                           'insecure': str(settings.INSECURE)}
-    manifest['synnefo'] = {'url': settings.AUTH_URL,
+                           'insecure': MANIFEST_INSECURE}
+    manifest['synnefo'] = {'url': _AUTH_URL,
                            'token': token}
     manifest['log'] = {'container': log['container'],
                        'object': log['object']}
@@ -140,6 +197,103 @@ def _create_manifest(build, token):
     return manifest
 
 
+def _token_hash(token):
+    """Returns the SHA-256 hex digest of a user token"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _invalidate_token(token):
+    """Remove a user token from the authentication cache"""
+    with _token_cache_lock:
+        _token_cache.pop(_token_hash(token)[:32], None)
+
+
+def _agent_destroyer(build, token=None):
+    """Returns a function that destroys the agent VM of a build. The build
+    fields it needs are captured now, so that the thread running it does not
+    have to fetch the build from the database again. If no token is given,
+    the stored token of the owner is used.
+    """
+    buildid, userid, agent = build.id, build.user, build.agent
+
+    @copy_current_request_context
+    def destroy_agent_wrapper():
+        """Thread that will kill the agent VM"""
+        destroy_agent_vm(buildid, userid, agent, token)
+
+    return destroy_agent_wrapper
+
+
+def _create_agent_config(buildid, nonce):
+    """Create the config file to be injected into the ICaaS Agent VM"""
+    return (AGENT_CONFIG_TEMPLATE % (buildid, nonce)).encode('utf-8')
+
+
+def _user_by_token(token):
+    """Returns a function that looks up the id and the uuid of the user a
+    token is stored for. The function returns None if there is no such user.
+    """
+    @copy_current_request_context
+    def lookup():
+        """Thread that will look up the user"""
+        return db.session.query(User.id, User.uuid).filter(
+            User.token == token).first()
+
+    return lookup
+
+
+def _set_user_token(userid, token):
+    """Store the token of a user unconditionally. The token is committed
+    together with the rest of the current transaction.
+    """
+    User.query.filter_by(id=userid).update(
+        {'token': token, 'token_updated': datetime.utcnow()},
+        synchronize_session=False)
+
+
+def _discard_lookup(future):
+    """Cancel a user lookup that is not needed anymore. If it is already
+    running, wait for it, since it uses the context of the current request.
+    """
+    if not future.cancel():
+        wait((future,))
+
+
+def _store_user_token(uuid, token):
+    """Store the token of a user, creating the user if needed. Returns the id
+    of the user and whether the token is the stored one.
+    """
+    user = User.query.filter_by(uuid=uuid).first()
+    now = datetime.utcnow()
+    if not user:
+        user = User(uuid)
+        user.token = token
+        user.token_updated = now
+        db.session.add(user)
+        db.session.flush()
+        userid = user.id
+        db.session.commit()
+        logger.debug('added new user %d' % userid)
+    elif user.token != token:
+        userid = user.id
+        if user.token_updated is None or \
+                now - user.token_updated > _TOKEN_UPDATE_INTERVAL:
+            user.token = token
+            user.token_updated = now
+            db.session.commit()
+            logger.debug('update existing user %d' % userid)
+        else:
+            # Tokens rotate often. Don't write to the database on every
+            # request, the stored token was valid a moment ago.
+            logger.debug('user %d found, stored token is recent' % userid)
+            return userid, False
+    else:
+        userid = user.id
+        logger.debug('user %d found' % userid)
+
+    return userid, True
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -148,35 +302,63 @@ def login_required(f):
             logger.debug('X-Auth-Token missing')
             raise Error("Token is missing", status=401)
         token = request.headers["X-Auth-Token"]
-        astakos = astakosclient.AstakosClient(token, settings.AUTH_URL)
-
+        token_hash = _token_hash(token)
+        key = token_hash[:32]
+
+        with _token_cache_lock:
+            cached = _token_cache.get(key)
+
+        if cached is not None:
+            if cached.token_hash == token_hash:
+                logger.debug('user %d found in the authentication cache' %
+                             cached.id)
+                return f(cached, *args, **kwargs)
+            _invalidate_token(token)
+
+        # Look up the user the token is stored for, while Astakos verifies
+        # it. This is only a guess and is checked against the Astakos reply.
+        guess = _lookups.submit(_user_by_token(token))
         try:
+            astakos = astakosclient.AstakosClient(token, _AUTH_URL)
             astakos = astakos.authenticate()
             logger.debug('X-Auth-Token is valid')
         except astakosclient.errors.Unauthorized:
             logger.debug('X-Auth-Token not valid')
+            _discard_lookup(guess)
+            _invalidate_token(token)
             raise Error("Invalid token", status=401)
         except Exception as e:
             logger.debug("astakosclient raised exception: '%s'" % str(e))
+            _discard_lookup(guess)
             raise Error("Internal server error", status=500)
 
+        try:
+            guess = guess.result()
+        except Exception as e:
+            # Not fatal, the user is looked up by uuid instead
+            logger.warning("user lookup by token failed: %s" % e)
+            guess = None
+
         logger.debug('checking if user is present in the database')
         uuid = astakos['access']['user']['id']
-        user = User.query.filter_by(uuid=uuid).first()
-        if not user:
-            user = User(astakos['access']['user']['id'])
-            user.token = token
-            db.session.add(user)
-            db.session.commit()
-            logger.debug('added new user %d' % user.id)
-        elif user.token != token:
-            user.token = token
-            db.session.commit()
-            logger.debug('update existing user %d' % user.id)
+        if guess is not None and guess.uuid == uuid:
+            userid = guess.id
+            stored = True
+            logger.debug('user %d found' % userid)
         else:
-            logger.debug('user %d found' % user.id)
-
-        return f(user, *args, **kwargs)
+            userid, stored = _store_user_token(uuid, token)
+
+        # The views only need the user id. Pass them the cache entry instead
+        # of the user object, which may have been expired by the commit.
+        cached = CachedUser(userid, uuid, token_hash)
+        if stored:
+            # Don't cache a token that was not stored. Cache hits don't store
+            # tokens, so the stored one would lag behind until the entry
+            # expires.
+            with _token_cache_lock:
+                _token_cache[key] = cached
+
+        return f(cached, *args, **kwargs)
     return decorated_function
 
 
@@ -202,29 +384,17 @@ def agent_manifest(buildid, nonce):
         logger.error("Unknown user: %d for build %d", (build.user, build.id))
 
     now = datetime.utcnow()
-    expires = build.created + timedelta(minutes=settings.MANIFEST_TIMEOUT)
+    expires = build.created + _MANIFEST_TIMEOUT
     if expires < now:
         logger.warning("Manifest retrieval expired!")
         build.nonce_invalid = True
         build.status = 'ERROR'
         build.details = 'Agent start up expired'
+        destroy_agent_wrapper = _agent_destroyer(build)
         db.session.commit()
 
-        @copy_current_request_context
-        def destroy_agent_wrapper():
-            """Thread that will kill the agent VM"""
-            build = Build.query.filter_by(id=buildid).first()
-            if build is None:
-                # Normally this cannot happen
-                logger.error('Build with id=%d not found!' % build.id)
-                return
-            destroy_agent(build)
-
         if not settings.DEBUG:
-            thread = threading.Thread(target=destroy_agent_wrapper,
-                                      name="DestroyAgentThread-%d" % build.id)
-            thread.daemon = False
-            thread.start()
+            _run_in_background(destroy_agent_wrapper)
         else:
             logger.warning('not deleting the agent VM on errors in debug mode')
         raise Error("Manifest retrieval expired", status=403)
@@ -273,26 +443,12 @@ def agent_update(buildid):
         build.status = status
 
         _update_status_details(build, params)
+        destroy_agent_wrapper = _agent_destroyer(build)
         db.session.commit()
 
         # Should we delete the agent VM?
         if status == "COMPLETED" or (status == "ERROR" and not settings.DEBUG):
-
-            @copy_current_request_context
-            def destroy_agent_wrapper():
-                """Thread that will kill the agent VM"""
-                # Check create_agent() to see why we are doing this
-                build = Build.query.filter_by(id=buildid).first()
-                if build is None:
-                    # Normally this cannot happen
-                    logger.error('Build with id=%d not found!' % build.id)
-                    return
-                destroy_agent(build)
-
-            thread = threading.Thread(target=destroy_agent_wrapper,
-                                      name="DestroyAgentThread-%d" % build.id)
-            thread.daemon = False
-            thread.start()
+            _run_in_background(destroy_agent_wrapper)
         elif status == 'ERROR':
             logger.warning('not deleting the agent VM on errors in debug mode')
 
@@ -308,8 +464,9 @@ def update(user, buildid):
     """Update the build status"""
     logger.info("update the build %d status by user %s" % (buildid, user.id))
 
-    build = Build.query.filter_by(id=buildid, user=user.id,
-                                  deleted=False).first()  # noqa
+    fields = ('id', 'user', 'status', 'status_details', 'agent')
+    build = Build.query.options(load_only(*fields)).filter_by(
+        id=buildid, user=user.id, deleted=False).first()  # noqa
     if not build:
         raise Error("Build not found", status=404)
 
@@ -330,25 +487,22 @@ def update(user, buildid):
     if not build.is_active():
         raise Error("Build is not active", status=403)
 
+    token = request.headers["X-Auth-Token"]
+
     build.status = 'CANCELED'
     _update_status_details(build, {'details': "Canceled by the user"})
+    # The stored token may be older than the one of this request and no
+    # longer valid. Destroy the agent VM with this one and store it.
+    _set_user_token(user.id, token)
+    # If the agent VM has not been created yet, create_agent() will take care
+    # of it when it sees that the build got canceled.
+    destroy_agent_wrapper = None
+    if build.agent:
+        destroy_agent_wrapper = _agent_destroyer(build, token)
     db.session.commit()
 
-    @copy_current_request_context
-    def destroy_agent_wrapper():
-        """Thread that will kill the agent VM"""
-        # Check create_agent() to see why we are doing this
-        build = Build.query.filter_by(id=buildid).first()
-        if build is None:
-            # Normally this cannot happen
-            logger.error('Build with id=%d not found!' % build.id)
-            return
-        destroy_agent(build)
-
-    thread = threading.Thread(target=destroy_agent_wrapper,
-                              name="DestroyAgentThread-%d" % build.id)
-    thread.daemon = False
-    thread.start()
+    if destroy_agent_wrapper:
+        _run_in_background(destroy_agent_wrapper)
 
     return Response(status=204)
 
@@ -373,31 +527,23 @@ def delete(user, buildid):
     """Delete an existing build entry"""
     logger.info("delete buildid %d by user %s" % (buildid, user.id))
 
-    build = Build.query.filter_by(id=buildid, user=user.id,
-                                  deleted=False).first()  # noqa
+    fields = ('id', 'user', 'deleted', 'agent_alive', 'agent')
+    build = Build.query.options(load_only(*fields)).filter_by(
+        id=buildid, user=user.id, deleted=False).first()  # noqa
     if not build:
         raise Error("Build not found", status=404)
-    build.deleted = True
-    db.session.commit()
 
-    buildid = build.id
+    token = request.headers["X-Auth-Token"]
 
-    @copy_current_request_context
-    def destroy_agent_wrapper():
-        """Thread that will kill the agent VM"""
-        # Check create_agent() to see why we are doing this
-        build = Build.query.filter_by(id=buildid).first()
-        if build is None:
-            # Normally this cannot happen
-            logger.error('Build with id=%d not found!' % build.id)
-            return
-        destroy_agent(build)
+    build.deleted = True
+    agent_alive = build.agent_alive
+    # Destroy the agent VM with the token of this request, as in update()
+    _set_user_token(user.id, token)
+    destroy_agent_wrapper = _agent_destroyer(build, token)
+    db.session.commit()
 
-    if build.agent_alive:
-        thread = threading.Thread(target=destroy_agent_wrapper,
-                                  name="DestroyAgentThread-%d" % build.id)
-        thread.daemon = False
-        thread.start()
+    if agent_alive:
+        _run_in_background(destroy_agent_wrapper)
 
     return Response(status=204)
 
@@ -465,81 +611,102 @@ def create(user):
     build = Build(user.id, name, descr, public, src, None, image, log)
     _update_status_details(build, {'details': "Build request accepted"})
     db.session.add(build)
-    db.session.commit()
-    logger.debug('created build %r' % build.id)
+    db.session.flush()
+
+    # The agent gets the stored token of the user and the agent VM is deleted
+    # with it. It must be the token of this request, even if another token of
+    # the user was stored a moment ago.
+    _set_user_token(user.id, token)
 
-    # Check comment below to see why we are doing this
+    # The commit expires the build object and accessing it afterwards would
+    # fetch it again from the database. Check the comment below to see why
+    # the build itself cannot be used by the agent creation thread.
     buildid = build.id
+    userid = user.id
+    nonce = build.nonce
+    build_dict = _build_to_dict(build)
+
+    db.session.commit()
+    logger.debug('created build %r' % buildid)
 
     @copy_current_request_context
     def create_agent():
         """Create ICaaS agent VM"""
 
-        # This is needed because the original build object is attached to the
-        # session of the father thread and any changes made to it from this
-        # thread won't be committed to the database using db.session.commit()
-        build = Build.query.filter_by(id=buildid,
-                                      deleted=False).first()  # noqa
-        if build is None:
-            # Normally this cannot happen
-            logger.error('Build with id=%d not found!' % build.id)
+        # The build may have been canceled or deleted while this task was
+        # waiting for a worker
+        row = db.session.query(Build.deleted, Build.status,
+                               Build.status_details).filter(
+            Build.id == buildid).first()
+        if row is None or row.deleted or row.status != 'CREATING':
+            logger.info('not creating an agent VM for inactive build %d' %
+                        buildid)
             return
 
         # Create the manifest URL
-        config = ConfigParser.ConfigParser()
-        config.add_section("manifest")
-        config.set("manifest", "url", "%s/builds/agent/%d/%s" %
-                   (settings.ENDPOINT, build.id, build.nonce))
-        manifest = StringIO.StringIO()
-        config.write(manifest)
+        config = _create_agent_config(buildid, nonce)
 
         personality = [
-            {'contents': b64encode(manifest.getvalue()), 'path': AGENT_CONFIG,
+            {'contents': b64encode(config), 'path': AGENT_CONFIG,
              'owner': 'root', 'group': 'root', 'mode': 0600},
-            {'contents': b64encode("empty"), 'path': AGENT_INIT,
+            {'contents': AGENT_INIT_CONTENTS, 'path': AGENT_INIT,
              'owner': 'root', 'group': 'root', 'mode': 0600}]
 
-        compute = cyclades.CycladesComputeClient(settings.COMPUTE_URL, token)
-        date = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        # Don't share compute clients between tasks. kamaki keeps the state
+        # of the running request, like its headers, on the client object. The
+        # HTTP connections are pooled per host anyway.
+        compute = cyclades.CycladesComputeClient(_COMPUTE_URL, token)
         try:
-            agent = compute.create_server("icaas-agent-%s-%s" %
-                                          (build.id, date),
-                                          settings.AGENT_IMAGE_FLAVOR_ID,
-                                          settings.AGENT_IMAGE_ID,
+            agent = compute.create_server("icaas-agent-%d" % buildid,
+                                          _AGENT_IMAGE_FLAVOR_ID,
+                                          _AGENT_IMAGE_ID,
                                           project_id=project,
                                           networks=networks,
                                           personality=personality)
         except ClientError as e:
-            build.status = 'ERROR'
-            msg = "ICaaS agent creation failed: (%d, %s)" % (e.status, e)
-            _update_status_details(build, {'details': msg})
-            db.session.commit()
-            logger.error("ICaaS agent creation failed: (%d, %s)"
-                         % (e.status, e))
-            return
+            if e.status == 401:
+                # The cached authentication of this token is not valid anymore
+                _invalidate_token(token)
+            agent = None
+            details = "ICaaS agent creation failed: (%d, %s)" % (e.status, e)
+            logger.error(details)
         except Exception as e:
-            build.status = 'ERROR'
-            params = {'details': "ICaaS agent creation failed"}
-            _update_status_details(build, params)
-            db.session.commit()
+            agent = None
+            details = "ICaaS agent creation failed"
             logger.error("ICaaS agent creation failed: %s" % e)
-            return
+        else:
+            logger.debug("create new ICaaS agent vm: %s" % agent)
+            details = "started ICaaS agent creation"
 
-        logger.debug("create new ICaaS agent vm: %s" % agent)
-        build.agent = agent['id']
-        build.agent_alive = True
-        params = {'details': "started ICaaS agent creation"}
-        _update_status_details(build, params)
+        if agent is None:
+            fields = {'status': 'ERROR'}
+        else:
+            fields = {'agent': agent['id'], 'agent_alive': True}
+        fields['status_details'] = _merge_status_details(row.status_details,
+                                                         {'details': details})
+
+        # The original build object is attached to the session of the father
+        # thread, so record the outcome with an UPDATE. It only applies if the
+        # build was not canceled or deleted while the agent VM was being
+        # created.
+        updated = Build.query.filter_by(
+            id=buildid, deleted=False, status='CREATING').update(
+            fields, synchronize_session=False)
         db.session.commit()
 
-    thread = threading.Thread(target=create_agent,
-                              name="CreateAgentThread-%d" % build.id)
-    thread.daemon = False
+        if not updated and agent is not None:
+            # Leave the status alone, but keep track of the VM until it is
+            # destroyed
+            Build.query.filter_by(id=buildid).update(
+                {'agent': agent['id'], 'agent_alive': True},
+                synchronize_session=False)
+            db.session.commit()
+            destroy_agent_vm(buildid, userid, agent['id'], token)
 
-    response = jsonify({"build": _build_to_dict(build)})
+    response = jsonify({"build": build_dict})
     response.status_code = 202
 
-    thread.start()
+    _run_in_background(create_agent)
     return response
 
 
@@ -555,24 +722,31 @@ def list_builds(user):
     # Check if details was provided
     details = request.args.get('details', '0')
 
-    if not status:
-        blds = Build.query.filter_by(user=user.id, deleted=False).all()  # noqa
-    elif status.upper() in ('CREATING', 'ERROR', 'COMPLETED'):
-        blds = Build.query.filter_by(user=user.id, deleted=False,
-                                     status=status.upper()).all()  # noqa
-    else:
+    if status and status.upper() not in ('CREATING', 'ERROR', 'COMPLETED'):
         raise Error("Invalid value for parameter 'status'. Valid values are: "
                     "'CREATING', 'ERROR', 'COMPLETED'")
 
     if details == '0':
-        result = [{"links": _build_to_links(b), "id": b.id, "name": b.name}
-                  for b in blds]
+        # Only the id and the name are needed. Don't construct Build objects
+        query = db.session.query(Build.id, Build.name)
     elif details == '1':
-        result = [_build_to_dict(b) for b in blds]
+        query = Build.query
     else:
         raise Error("Invalid value for parameter 'details'. Valid values are: "
                     "'0' and '1'")
 
+    query = query.filter(Build.user == user.id,
+                         Build.deleted == False)  # noqa
+    if status:
+        query = query.filter(Build.status == status.upper())
+    blds = query.all()
+
+    if details == '0':
+        result = [{"links": _build_to_links(b), "id": b.id, "name": b.name}
+                  for b in blds]
+    else:
+        result = [_build_to_dict(b) for b in blds]
+
     return jsonify({"builds": result})
 
 # vim: ai ts=4 sts=4 et sw=4 ft=python
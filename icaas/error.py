@@ -19,9 +19,44 @@
 """Module to handle API errors"""
 
 import logging
+import threading
+
+from flask import jsonify, request, current_app
+import cachetools
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of error response bodies to keep per application
+ERROR_CACHE_SIZE = 256
+
+_error_cache_lock = threading.Lock()
+
+
+def _error_body(message, status, pretty):
+    """Returns the body and the mimetype of the jsonify() response for an
+    error without payload.
+
+    jsonify() output depends on the configuration of the application, e.g.
+    JSON_SORT_KEYS or its JSON encoder, so each application has its own
+    cache. Whether jsonify() pretty prints for the current request is the
+    only other input, so it is part of the key.
+    """
+    key = (message, status, pretty)
+    with _error_cache_lock:
+        cache = current_app.extensions.get('icaas_errors')
+        if cache is None:
+            cache = current_app.extensions['icaas_errors'] = \
+                cachetools.LRUCache(maxsize=ERROR_CACHE_SIZE)
+        cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    response = jsonify({'message': message, 'status': status})
+    cached = response.get_data(), response.mimetype
+    with _error_cache_lock:
+        cache[key] = cached
+    return cached
+
 
 class Error(Exception):
     """Implements the Error Exception"""
@@ -34,7 +69,8 @@ class Error(Exception):
         if status is not None:
             self.status = status
         self.payload = payload
-        logger.debug("Error: %s" % self.to_dict())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Error: %s" % self.to_dict())
 
     def to_dict(self):
         rv = dict(self.payload or ())
@@ -42,4 +78,17 @@ class Error(Exception):
         rv['status'] = self.status
         return rv
 
+    def to_response(self):
+        """Returns a JSON response describing the error"""
+        if self.payload:
+            response = jsonify(self.to_dict())
+            response.status_code = self.status
+            return response
+
+        pretty = current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] and \
+            not request.is_xhr
+        body, mimetype = _error_body(self.message, self.status, pretty)
+        return current_app.response_class(body, status=self.status,
+                                          mimetype=mimetype)
+
 # vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy.types import TypeDecorator, String
 from datetime import datetime
 from uuid import uuid4
 from base64 import urlsafe_b64encode as b64encode
@@ -27,6 +28,19 @@ import json
 db = SQLAlchemy()
 
 
+class JSONEncoded(TypeDecorator):
+    """Stores a structure as a JSON string. The string is parsed once, when
+    the row is loaded. The structure is not tracked for in-place changes.
+    """
+    impl = String
+
+    def process_bind_param(self, value, dialect):
+        return json.dumps(value) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return json.loads(value) if value is not None else None
+
+
 class Build(db.Model):
     """Represents the Build model"""
     __tablename__ = 'build'
@@ -51,9 +65,9 @@ class Build(db.Model):
     # User Provided Image URL
     src = db.Column(db.String(256))
     # Pithos Image Object
-    image = db.Column(db.String(256))
+    image = db.Column(JSONEncoded(256))
     # ICaaS creation log in Pithos
-    log = db.Column(db.String(256))
+    log = db.Column(JSONEncoded(256))
     # Build creation time
     created = db.Column(db.DateTime, default=datetime.utcnow)
     # Build update time
@@ -72,8 +86,11 @@ class Build(db.Model):
     # Has the nonce been invalidated?
     nonce_invalid = db.Column(db.Boolean, default=False)
 
-    # Index to be used to check if the agent VM timed out
-    __table_args__ = (db.Index('agent_alive_index', 'agent_alive', 'created'),)
+    __table_args__ = (
+        # Index to be used to check if the agent VM timed out
+        db.Index('agent_alive_index', 'agent_alive', 'created'),
+        # Index to be used to look up the builds of a user
+        db.Index('ix_build_user_deleted', 'user', 'deleted'))
 
     def __init__(self, user, name, descr, public, src, agent, image, log):
         """Initialize a Build object"""
@@ -87,8 +104,8 @@ class Build(db.Model):
         self.public = public
         self.src = src
         self.agent = agent
-        self.image = json.dumps(image)
-        self.log = json.dumps(log)
+        self.image = image
+        self.log = log
         self.token = str(uuid4()).replace('-', '')
         self.nonce = b64encode(uuid4().bytes + uuid4().bytes).strip('=')
 
@@ -113,7 +130,9 @@ class User(db.Model):
     # Synnefo UUID of the User
     uuid = db.Column(db.String(256), unique=True, index=True)
     # Synnefo User token
-    token = db.Column(db.String(64))
+    token = db.Column(db.String(64), index=True)
+    # Last time the Synnefo User token was updated
+    token_updated = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __init__(self, uuid):
         """Initialize a User object"""
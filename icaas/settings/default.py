@@ -56,10 +56,29 @@ MANIFEST_TIMEOUT = 20
 # The time in minutes to wait for the agent to finish the image creation
 AGENT_TIMEOUT = 60
 
+# Maximum number of threads creating or destroying agent VMs concurrently
+AGENT_WORKERS = 8
+
+# Maximum number of threads looking up users while Astakos authenticates them.
+# Each request that misses the authentication cache needs one of them, so set
+# this to the number of requests a process serves concurrently, e.g. the
+# threads of a WSGI worker. Requests beyond that wait for a free thread.
+LOOKUP_WORKERS = 4
+
 # Linear multiplier for the heuristic progress feature
 PROGRESS_HEURISTIC = 6.75
 
 # Interval -in seconds- to report the progress status to the server
 PROGRESS_INTERVAL = 5
 
+# Time in seconds to cache a successful user token authentication
+TOKEN_CACHE_TTL = 300
+
+# Maximum number of user token authentications to cache
+TOKEN_CACHE_SIZE = 10000
+
+# Minimum time in seconds between two updates of the stored user token. A
+# newer token seen within this period is not written to the database.
+TOKEN_UPDATE_INTERVAL = 60
+
 # vim: ai ts=4 sts=4 et sw=4 ft=python
@@ -18,9 +18,12 @@
 
 
 import logging
-import threading
+import ConfigParser
+from cStringIO import StringIO
+from datetime import datetime
 
-from flask import json
+from concurrent.futures import ThreadPoolExecutor
+from flask import json, jsonify
 from flask.ext.testing import TestCase
 from mock import patch, Mock
 
@@ -28,6 +31,8 @@ import astakosclient
 
 from icaas import create_app, settings
 from icaas.models import db, Build, User
+from icaas.error import Error
+from icaas.controllers import builds as controller
 
 
 logger = logging.getLogger(__name__)
@@ -88,6 +93,24 @@ def create_test_build():
     return (user, build)
 
 
+class HeldExecutor(object):
+    """Executor that keeps the submitted tasks until they are released"""
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, fn):
+        self.tasks.append(fn)
+
+
+def cancel_all_builds(*args, **kwargs):
+    """Cancel all builds, as if the user did it while the agent VM was being
+    created
+    """
+    Build.query.update({'status': 'CANCELED'})
+    db.session.commit()
+    return {u'id': VM_ID}
+
+
 class IcaasTestCase(TestCase):
     """ICaaS unittests class"""
     def create_app(self):
@@ -131,12 +154,42 @@ class IcaasTestCase(TestCase):
     def setUp(self):
         """Setup the application's database"""
         db.create_all()
+        controller._token_cache.clear()
+        # Use a private executor to be able to wait for the agent threads
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor_patch = patch.object(controller, '_executor',
+                                           self.executor)
+        self.executor_patch.start()
 
     def tearDown(self):
         """Remove the application's database"""
+        self.wait_for_agent_threads()
+        self.executor_patch.stop()
         db.session.remove()
         db.drop_all()
 
+    def wait_for_agent_threads(self):
+        """Wait for the agent creation and destruction threads to finish"""
+        self.executor.shutdown(wait=True)
+
+    def request_build(self, token=USER_TOKEN):
+        """Request a new build and return its id"""
+        data = dict(build=dict(name=u'Test Image', src='http://example.org',
+                               image=dict(container='pithos', object='image'),
+                               log=dict(container='pithos', object='log')))
+        rv = self.client.post('/icaas/builds',
+                              headers=[('X-Auth-Token', token)],
+                              data=json.dumps(data),
+                              content_type='application/json')
+        self.assertEquals(rv.status_code, 202)
+        return json.loads(rv.data)['build']['id']
+
+    def release_agent_threads(self, held):
+        """Run the tasks kept by a HeldExecutor and wait for them"""
+        for task in held.tasks:
+            self.executor.submit(task)
+        self.wait_for_agent_threads()
+
     @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
     def test_authorized(self):
         """Test an authorized access request"""
@@ -151,6 +204,164 @@ class IcaasTestCase(TestCase):
                              headers=[('X-Auth-Token', 'test')])
         self.assertEquals(rv.status_code, 401)
 
+    def test_token_cache(self):
+        """Test that successful authentications are cached"""
+        authenticate = Mock(return_value=astakos_authorized.return_value)
+        lookup = Mock(wraps=controller._user_by_token)
+        store = Mock(wraps=controller._store_user_token)
+        commit = Mock(wraps=db.session.commit)
+        with patch('astakosclient.AstakosClient.authenticate', authenticate), \
+                patch.object(controller, '_user_by_token', lookup), \
+                patch.object(controller, '_store_user_token', store), \
+                patch.object(db.session, 'commit', commit):
+            for i in range(2):
+                rv = self.client.get('/icaas/builds',
+                                     headers=[('X-Auth-Token', USER_TOKEN)])
+                self.assertEquals(rv.status_code, 200)
+                if i == 0:
+                    self.assertTrue(store.called)
+                    for mock in (lookup, store, commit):
+                        mock.reset_mock()
+        self.assertEquals(authenticate.call_count, 1)
+        # The cached user is used as is, without touching the database
+        self.assertFalse(lookup.called)
+        self.assertFalse(store.called)
+        self.assertFalse(commit.called)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_user_guess_hit(self):
+        """Test that a user found by the token lookup is not looked up again"""
+        create_test_user()
+
+        store = Mock(wraps=controller._store_user_token)
+        with patch.object(controller, '_store_user_token', store):
+            rv = self.client.get('/icaas/builds',
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        self.assertFalse(store.called)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_user_guess_miss(self):
+        """Test that a token lookup finding another user is not trusted"""
+        user = User(u'another-uuid')
+        user.token = USER_TOKEN
+        db.session.add(user)
+        db.session.commit()
+
+        store = Mock(wraps=controller._store_user_token)
+        with patch.object(controller, '_store_user_token', store):
+            rv = self.client.get('/icaas/builds',
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        store.assert_called_once_with(USER_ID, USER_TOKEN)
+        self.assertEquals(User.query.filter_by(uuid=USER_ID).first().token,
+                          USER_TOKEN)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_user_guess_failure(self):
+        """Test that a failing token lookup falls back to the uuid lookup"""
+        create_test_user()
+
+        lookup = Mock(return_value=Mock(
+            side_effect=Exception('database error')))
+        store = Mock(wraps=controller._store_user_token)
+        with patch.object(controller, '_store_user_token', store), \
+                patch.object(controller, '_user_by_token', lookup):
+            rv = self.client.get('/icaas/builds?details=1',
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 200)
+        store.assert_called_once_with(USER_ID, USER_TOKEN)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_unauthorized)
+    def test_user_guess_canceled(self):
+        """Test that the token lookup is canceled if the token is invalid"""
+        lookups = Mock()
+        with patch.object(controller, '_lookups', lookups):
+            rv = self.client.get('/icaas/builds',
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+        self.assertEquals(rv.status_code, 401)
+        lookups.submit.return_value.cancel.assert_called_once_with()
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_new_token_in_manifest(self):
+        """Test that a build gets the token it was requested with"""
+        create_test_user()
+
+        new_token = 'newtoken'
+        held = HeldExecutor()
+        with patch.object(controller, '_executor', held):
+            buildid = self.request_build(token=new_token)
+
+        build = Build.query.get(buildid)
+        rv = self.client.get('/icaas/builds/agent/%d/%s' %
+                             (build.id, build.nonce))
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(json.loads(rv.data)['manifest']['synnefo']['token'],
+                          new_token)
+
+    def test_recent_token_not_stored(self):
+        """Test that a new token is not stored if the stored one is recent"""
+        user = create_test_user()
+        user.token_updated = datetime.utcnow()
+        db.session.commit()
+
+        self.assertEquals(controller._store_user_token(USER_ID, 'newtoken'),
+                          (user.id, False))
+        self.assertEquals(User.query.get(user.id).token, USER_TOKEN)
+
+    def test_old_token_replaced(self):
+        """Test that a new token is stored if the stored one is old"""
+        user = create_test_user()
+        user.token_updated = datetime.utcnow() - \
+            2 * controller._TOKEN_UPDATE_INTERVAL
+        db.session.commit()
+
+        self.assertEquals(controller._store_user_token(USER_ID, 'newtoken'),
+                          (user.id, True))
+        self.assertEquals(User.query.get(user.id).token, 'newtoken')
+
+    def test_unknown_token_age_replaced(self):
+        """Test that a new token is stored if the stored one has no date"""
+        user = create_test_user()
+        user.token_updated = None
+        db.session.commit()
+
+        self.assertEquals(controller._store_user_token(USER_ID, 'newtoken'),
+                          (user.id, True))
+        self.assertEquals(User.query.get(user.id).token, 'newtoken')
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_new_token_not_cached_if_not_stored(self):
+        """Test that a token which was not stored is not cached"""
+        create_test_user()
+
+        rv = self.client.get('/icaas/builds',
+                             headers=[('X-Auth-Token', 'newtoken')])
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(len(controller._token_cache), 0)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_new_token_deletes_agent(self):
+        """Test that the agent VM is destroyed with the token of the request
+        that deletes the build
+        """
+        user, build = create_test_build()
+        build.agent = VM_ID
+        build.agent_alive = True
+        db.session.commit()
+
+        with patch('icaas.utils.cyclades') as cyclades:
+            rv = self.client.delete('/icaas/builds/%d' % build.id,
+                                    headers=[('X-Auth-Token', 'newtoken')])
+            self.assertEquals(rv.status_code, 204)
+            self.wait_for_agent_threads()
+
+        cyclades.CycladesComputeClient.assert_called_once_with(
+            settings.COMPUTE_URL, 'newtoken')
+        compute = cyclades.CycladesComputeClient.return_value
+        compute.delete_server.assert_called_once_with(VM_ID)
+        self.assertEquals(User.query.get(user.id).token, 'newtoken')
+
     @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
     @patch('kamaki.clients.cyclades.CycladesComputeClient.create_server',
            kamaki_create_server)
@@ -170,9 +381,7 @@ class IcaasTestCase(TestCase):
                               content_type='application/json')
 
         # Wait for the agent creation thread to finish
-        for t in threading.enumerate():
-            if t.name.startswith('CreateAgentThread'):
-                t.join()
+        self.wait_for_agent_threads()
 
         self.assertEquals(json.loads(rv.data)['build']['id'], 1)
         builds = Build.query.all()
@@ -181,8 +390,49 @@ class IcaasTestCase(TestCase):
         self.assertEquals(build.agent, VM_ID)
         self.assertEquals(build.agent_alive, True)
         self.assertEquals(build.src, 'http://example.org')
-        self.assertEquals(json.loads(build.image), image)
-        self.assertEquals(json.loads(build.log), log)
+        self.assertEquals(build.image, image)
+        self.assertEquals(build.log, log)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_list_builds(self):
+        """Test listing the builds of a user"""
+        user, build = create_test_build()
+        failed = Build(
+            user.id, "Failed Image", None, False,
+            "http://example.org/failed.diskdump", 0,
+            dict(container='image', object='failed.diskdump'),
+            dict(container='icaas', object='failed.txt'))
+        failed.status = 'ERROR'
+        db.session.add(failed)
+        db.session.commit()
+
+        def list_builds(query):
+            rv = self.client.get('/icaas/builds?%s' % query,
+                                 headers=[('X-Auth-Token', USER_TOKEN)])
+            self.assertEquals(rv.status_code, 200)
+            return json.loads(rv.data)['builds']
+
+        def links(buildid):
+            return [{'href': '%s/%d' % (settings.ENDPOINT, buildid),
+                     'rel': 'self'}]
+
+        builds = list_builds('details=0')
+        self.assertEquals(builds, [
+            {'id': build.id, 'name': "Test Image", 'links': links(build.id)},
+            {'id': failed.id, 'name': "Failed Image",
+             'links': links(failed.id)}])
+
+        builds = list_builds('details=1')
+        self.assertEquals([(b['id'], b['name'], b['links']) for b in builds],
+                          [(build.id, "Test Image", links(build.id)),
+                           (failed.id, "Failed Image", links(failed.id))])
+        self.assertEquals(builds[0]['image'],
+                          dict(container='image', object='test.diskdump'))
+        self.assertEquals(builds[1]['status'], 'ERROR')
+
+        builds = list_builds('status=error')
+        self.assertEquals(builds, [{'id': failed.id, 'name': "Failed Image",
+                                    'links': links(failed.id)}])
 
     @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
     @patch('kamaki.clients.cyclades.CycladesComputeClient.delete_server',
@@ -200,9 +450,7 @@ class IcaasTestCase(TestCase):
         self.assertEquals(rv.status_code, 204)
 
         # Wait for the agent destruction thread to finish
-        for t in threading.enumerate():
-            if t.name.startswith('DestroyAgentThread'):
-                t.join()
+        self.wait_for_agent_threads()
 
         rv = self.client.get('/icaas/builds/%d' % build.id,
                              headers=[('X-AUTH-Token', USER_TOKEN)])
@@ -239,9 +487,71 @@ class IcaasTestCase(TestCase):
         self.assertEquals(rv.status_code, 204)
 
         # Wait for the agent destruction thread to finish
-        for t in threading.enumerate():
-            if t.name.startswith('DestroyAgentThread'):
-                t.join()
+        self.wait_for_agent_threads()
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_cancel_before_agent_creation(self):
+        """Test canceling a build before its agent VM creation started"""
+        held = HeldExecutor()
+        create_server = Mock(return_value={u'id': VM_ID})
+        delete_server = Mock(return_value="")
+        with patch.object(controller, '_executor', held), \
+                patch('kamaki.clients.cyclades.CycladesComputeClient.'
+                      'create_server', create_server), \
+                patch('kamaki.clients.cyclades.CycladesComputeClient.'
+                      'delete_server', delete_server):
+            buildid = self.request_build()
+            rv = self.client.put('/icaas/builds/%d' % buildid,
+                                 headers=[('X-AUTH-Token', USER_TOKEN)],
+                                 data=json.dumps({'action': 'cancel'}),
+                                 content_type='application/json')
+            self.assertEquals(rv.status_code, 204)
+            # There is no agent VM to destroy yet
+            self.assertEquals(len(held.tasks), 1)
+            self.release_agent_threads(held)
+
+        self.assertFalse(create_server.called)
+        self.assertFalse(delete_server.called)
+        build = Build.query.get(buildid)
+        self.assertEquals(build.status, 'CANCELED')
+        self.assertEquals(json.loads(build.status_details)['details'],
+                          "Canceled by the user")
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_delete_before_agent_creation(self):
+        """Test deleting a build before its agent VM creation started"""
+        held = HeldExecutor()
+        create_server = Mock(return_value={u'id': VM_ID})
+        with patch.object(controller, '_executor', held), \
+                patch('kamaki.clients.cyclades.CycladesComputeClient.'
+                      'create_server', create_server):
+            buildid = self.request_build()
+            rv = self.client.delete('/icaas/builds/%d' % buildid,
+                                    headers=[('X-AUTH-Token', USER_TOKEN)])
+            self.assertEquals(rv.status_code, 204)
+            self.release_agent_threads(held)
+
+        self.assertFalse(create_server.called)
+        self.assertFalse(Build.query.get(buildid).agent_alive)
+
+    @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
+    def test_cancel_during_agent_creation(self):
+        """Test canceling a build while its agent VM is being created"""
+        delete_server = Mock(return_value="")
+        with patch('kamaki.clients.cyclades.CycladesComputeClient.'
+                   'create_server', Mock(side_effect=cancel_all_builds)), \
+                patch('kamaki.clients.cyclades.CycladesComputeClient.'
+                      'delete_server', delete_server):
+            buildid = self.request_build()
+            self.wait_for_agent_threads()
+
+        delete_server.assert_called_once_with(VM_ID)
+        build = Build.query.get(buildid)
+        self.assertEquals(build.status, 'CANCELED')
+        self.assertEquals(build.agent, VM_ID)
+        self.assertFalse(build.agent_alive)
+        self.assertNotEquals(json.loads(build.status_details)['details'],
+                             "started ICaaS agent creation")
 
     @patch('astakosclient.AstakosClient.authenticate', astakos_authorized)
     def test_invalid_update_action(self):
@@ -279,6 +589,47 @@ class IcaasTestCase(TestCase):
                                 headers=[('X-AUTH-Token', user.token)])
         self.assertEquals(rv.status_code, 404)
 
+    def test_background_task_failure(self):
+        """Test that failing background tasks are logged"""
+        def task():
+            raise Exception('failed')
+
+        with patch.object(controller, 'logger') as log:
+            controller._run_in_background(task)
+            self.wait_for_agent_threads()
+        self.assertEquals(log.exception.call_count, 1)
+
+    def test_error_response(self):
+        """Test that error responses are the ones jsonify() would create"""
+        errors = (Error("Invalid token", status=401),
+                  Error("Invalid parameter", payload={'parameter': 'name'}))
+        for error in errors:
+            expected = jsonify(error.to_dict())
+            # The second time the body of errors without payload is cached
+            for i in range(2):
+                response = error.to_response()
+                self.assertEquals(response.status_code, error.status)
+                self.assertEquals(response.mimetype, 'application/json')
+                self.assertEquals(response.get_data(), expected.get_data())
+
+    def test_agent_config(self):
+        """Test that the agent config file is a valid INI file"""
+        user, build = create_test_build()
+
+        config = controller._create_agent_config(build.id, build.nonce)
+        parser = ConfigParser.ConfigParser()
+        parser.readfp(StringIO(config))
+        self.assertEquals(parser.get('manifest', 'url'),
+                          '%s/builds/agent/%d/%s' %
+                          (settings.ENDPOINT, build.id, build.nonce))
+
+        expected = ConfigParser.ConfigParser()
+        expected.add_section('manifest')
+        expected.set('manifest', 'url', parser.get('manifest', 'url'))
+        output = StringIO()
+        expected.write(output)
+        self.assertEquals(config, output.getvalue())
+
     def test_agent_manifest_fetching(self):
         """Test the agent manifest fetching"""
 
@@ -28,39 +28,54 @@ from icaas import settings
 
 logger = logging.getLogger(__name__)
 
+_COMPUTE_URL = settings.COMPUTE_URL
+
 
 def destroy_agent(build):
     """Destroy the agent associated with a build"""
-    logger.info('destroy_agent of build %d' % build.id)
+    return destroy_agent_vm(build.id, build.user, build.agent)
 
-    user = User.query.filter_by(id=build.user).first()
-    if not user:
-        logger.error('unable to find user %d to delete the agent VM' %
-                     build.id)
-        return False
 
-    compute = cyclades.CycladesComputeClient(settings.COMPUTE_URL, user.token)
+def destroy_agent_vm(buildid, userid, agent, token=None):
+    """Destroy the agent VM of a build without loading the build itself. The
+    stored token of the user is used, unless a token is given.
+    """
+    logger.info('destroy_agent of build %d' % buildid)
+
+    if token is None:
+        user = User.query.filter_by(id=userid).first()
+        if not user:
+            logger.error('unable to find user %d to delete the agent VM' %
+                         userid)
+            return False
+        token = user.token
+
+    compute = cyclades.CycladesComputeClient(_COMPUTE_URL, token)
     try:
-        compute.delete_server(build.agent)
+        compute.delete_server(agent)
     except ClientError as e:
         logger.error('failed to delete the icaas agent of build %d: (%d, %s)'
-                     % (build.id, e.status, e))
+                     % (buildid, e.status, e))
         if e.status == 400:  # The server is probably dead already
-            build.agent_alive = False
-            db.session.commit()
+            _set_agent_dead(buildid)
             return True
         return False
 
     except Exception as e:
         logger.error('failed to delete the icaas agent of build %d: %s'
-                     % (build.id, e))
+                     % (buildid, e))
         return False
 
-    build.agent_alive = False
-    db.session.commit()
+    _set_agent_dead(buildid)
     return True
 
 
+def _set_agent_dead(buildid):
+    """Mark the agent VM of a build as not alive"""
+    Build.query.filter_by(id=buildid).update({'agent_alive': False})
+    db.session.commit()
+
+
 def exec_on_timeout(timeout, action):
     """Perform an action on all the builds that have timed out"""
 